@@ -0,0 +1,30 @@
+# gunicorn_conf.py - Production server settings for app.py
+# Run: gunicorn -c gunicorn_conf.py app:app
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Threaded workers: each viewer's /stream requests run concurrently instead
+# of queueing behind one another, and gunicorn's wsgi.file_wrapper serves
+# the ranges with sendfile(2). app.py's shared SQLite connection and caches
+# are guarded by locks, so threads are safe without any monkey-patching.
+worker_class = 'gthread'
+
+# Each worker is a separate process with its own copy of app.py's record
+# and mmap caches; an insert in one worker is invisible to the others'
+# caches. Those caches therefore only hold data that can never go stale
+# (existing, immutable records and upload files, never misses), and any
+# new process-local cache must follow the same rule.
+workers = int(os.environ.get('WEB_CONCURRENCY', (os.cpu_count() or 1) * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+
+# Do not preload: app.py opens its SQLite connection at import, and that
+# connection must not be shared across forked workers.
+preload_app = False
+
+# For gthread workers this is only the worker heartbeat: a worker that
+# stops checking in for this long is restarted. It does not limit how long
+# a single request (e.g. a slow /download) may hold its thread.
+timeout = 60
+keepalive = 5